@@ -1,21 +1,36 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import List, Optional
+from pydantic import BaseModel, ValidationError, conlist
+from typing import Optional
+import anyio.to_thread
+import hashlib
 import json
+import orjson
+import redis
+import os
+
+# Point pymssql's bundled FreeTDS at the repo's freetds.conf (TDS version and
+# packet size); must be set before the driver loads its configuration.
+os.environ.setdefault(
+    "FREETDSCONF",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "freetds.conf")
+)
+
 import pymssql  # Changed from pyodbc to pymssql
+from pymssql import _mssql
 import logging
+import queue
+import threading
 import time
 from contextlib import contextmanager
-from tqdm import tqdm
-import pandas as pd
+from functools import partial
 import decimal
 from datetime import datetime, date
-import os
-from fastapi.responses import HTMLResponse
-from functools import lru_cache
+from fastapi.responses import HTMLResponse, ORJSONResponse
+from cachetools import TTLCache
 from dotenv import load_dotenv
-import sys
 
 # Load environment variables
 load_dotenv()
@@ -23,19 +38,65 @@ load_dotenv()
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(sys.stdout)
-    ]
-)
+logger.setLevel(logging.INFO)
 
 # Cache configuration
 CACHE_SIZE = 128
 CACHE_TTL = 3600  # 1 hour in seconds
+# Requests with more input rows than this are processed but never cached
+CACHE_ROW_LIMIT = 50_000
+
+# Maximum memberships / diagnoses accepted in a single request
+MAX_INPUT_ROWS = 200_000
+# Maximum /process_data body size, checked before the body is buffered
+MAX_BODY_BYTES = int(os.getenv("MAX_BODY_BYTES", 100 * 1024 * 1024))
+
+# SP result rows (ready to serialize) keyed by a hash of the request
+# payload; entries expire after CACHE_TTL
+_cache = TTLCache(maxsize=CACHE_SIZE, ttl=CACHE_TTL)
+_cache_lock = threading.Lock()
+
+# Optional Redis cache shared by all workers; replaces the in-process cache
+# when REDIS_URL is set
+REDIS_URL = os.getenv("REDIS_URL")
+REDIS_KEY_PREFIX = b"raf:process_data:"
+# Keep Redis stalls short; a slow cache is treated as a miss
+REDIS_CONNECT_TIMEOUT = float(os.getenv("REDIS_CONNECT_TIMEOUT", 0.5))
+REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", 1.0))
+_redis = redis.Redis.from_url(
+    REDIS_URL,
+    socket_connect_timeout=REDIS_CONNECT_TIMEOUT,
+    socket_timeout=REDIS_SOCKET_TIMEOUT
+) if REDIS_URL else None
+
+# Database connection pool configuration (per worker process)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 20))
+DB_POOL_TIMEOUT = 30  # seconds to wait for a free connection
+
+# Worker threads available for blocking database calls
+THREAD_POOL_SIZE = 64
+
+# Rows per BCP batch when loading the temp tables
+BULK_COPY_BATCH_SIZE = 10000
+# INSERT statements per round-trip when BCP fails
+INSERT_BATCH_SIZE = 1000
+# Rows read per fetchmany call when draining the SP result set
+FETCH_BATCH_SIZE = 5000
 
-app = FastAPI(title="RAF Calculator API")
+def orjson_default(value):
+    """Serialize types orjson has no native support for."""
+    if isinstance(value, decimal.Decimal):
+        # Same int/float choice as FastAPI's jsonable_encoder
+        return int(value) if value.as_tuple().exponent >= 0 else float(value)
+    raise TypeError
+
+class RAFJSONResponse(ORJSONResponse):
+    """ORJSONResponse that also handles the Decimal values pymssql returns."""
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, default=orjson_default)
+
+app = FastAPI(title="RAF Calculator API", default_response_class=RAFJSONResponse)
 
 # Add CORS middleware
 app.add_middleware(
@@ -49,7 +110,7 @@ app.add_middleware(
 # Pydantic models
 class Membership(BaseModel):
     MemberID: str
-    DOB: str
+    DOB: date
     Gender: str
     RAType: str
     Hospice: str
@@ -62,16 +123,22 @@ class Membership(BaseModel):
 
 class Diagnosis(BaseModel):
     MemberID: str
-    FromDOS: str
-    ThruDOS: str
+    FromDOS: date
+    ThruDOS: date
     DxCode: str
     QualificationFlag: int
     UnqualificationReason: str
 
 class ProcessDataRequest(BaseModel):
     dos_year: int
-    memberships: List[Membership]
-    diagnoses: List[Diagnosis]
+    memberships: conlist(Membership, max_length=MAX_INPUT_ROWS)
+    diagnoses: conlist(Diagnosis, max_length=MAX_INPUT_ROWS)
+
+# Connection pool: idle connections are kept in _pool, and at most
+# DB_POOL_SIZE connections are open per worker process at any time.
+_pool = queue.Queue(maxsize=DB_POOL_SIZE)
+_pool_lock = threading.Lock()
+_pool_created = 0
 
 def get_db_connection():
     """Establish a connection to the database."""
@@ -83,30 +150,97 @@ def get_db_connection():
             password='etl_user',
             port='1433',
             charset='UTF-8',
+            tds_version='7.4',
             timeout=30
         )
-        logger.info("Database connection successful")
+        logger.debug("Database connection successful")
         return conn
     except pymssql.Error as e:
         logger.error(f"Database connection error: {str(e)}")
         raise
 
+def ping_connection(conn):
+    """Check that a pooled connection is still usable."""
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT 1")
+        cursor.fetchall()
+        cursor.close()
+        return True
+    except Exception:
+        return False
+
+def discard_connection(conn):
+    """Close a connection and free its slot in the pool."""
+    global _pool_created
+    try:
+        conn.close()
+    except:
+        pass
+    with _pool_lock:
+        _pool_created -= 1
+
+def acquire_connection():
+    """Take a live connection from the pool, opening one if there is room."""
+    global _pool_created
+    try:
+        conn = _pool.get_nowait()
+    except queue.Empty:
+        with _pool_lock:
+            can_open = _pool_created < DB_POOL_SIZE
+            if can_open:
+                _pool_created += 1
+        if can_open:
+            try:
+                return get_db_connection()
+            except Exception:
+                with _pool_lock:
+                    _pool_created -= 1
+                raise
+        try:
+            conn = _pool.get(timeout=DB_POOL_TIMEOUT)
+        except queue.Empty:
+            raise RuntimeError("Timed out waiting for a database connection")
+
+    if ping_connection(conn):
+        return conn
+    logger.warning("Discarding stale database connection")
+    try:
+        conn.close()
+    except:
+        pass
+    try:
+        return get_db_connection()
+    except Exception:
+        with _pool_lock:
+            _pool_created -= 1
+        raise
+
+def release_connection(conn):
+    """Return a connection to the pool."""
+    try:
+        _pool.put_nowait(conn)
+    except queue.Full:
+        discard_connection(conn)
+
 @contextmanager
 def get_db_cursor():
-    """Context manager for database connections."""
+    """Context manager for pooled database connections."""
     conn = None
     cursor = None
+    healthy = True
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor(as_dict=True)
-        yield cursor
-        conn.commit()
+        conn = acquire_connection()
+        cursor = conn.cursor()
+        yield conn, cursor
+        if not conn.autocommit_state:
+            conn.commit()
     except Exception as e:
-        if conn:
+        if conn and not conn.autocommit_state:
             try:
                 conn.rollback()
             except:
-                pass
+                healthy = False
         raise
     finally:
         if cursor:
@@ -114,15 +248,30 @@ def get_db_cursor():
                 cursor.close()
             except:
                 pass
-        if conn:
+        if conn and healthy and conn.autocommit_state:
+            # Pooled connections must go back in manual-commit mode
             try:
-                conn.close()
+                conn.autocommit(False)
             except:
-                pass
+                healthy = False
+        if conn:
+            if healthy:
+                release_connection(conn)
+            else:
+                discard_connection(conn)
 
 def create_temp_tables(cursor):
-    """Create temporary tables for both membership and diagnosis data."""
+    """Create temporary tables for both membership and diagnosis data.
+
+    pymssql cannot bind table-valued parameters, so rows are staged here and
+    copied into the SP's InputMembership_PartC / InputDiagnosisSuspect tables
+    server-side.
+    """
+    # NOCOUNT is session-wide, so it also silences the row-count tokens sent
+    # for the bulk loads and the SP batch that follow on this connection.
     cursor.execute("""
+    SET NOCOUNT ON;
+
     IF OBJECT_ID('tempdb..#TempMembership') IS NOT NULL
         DROP TABLE #TempMembership;
     IF OBJECT_ID('tempdb..#TempDiagnosis') IS NOT NULL
@@ -150,128 +299,282 @@ def create_temp_tables(cursor):
     );
     """)
 
-@lru_cache(maxsize=CACHE_SIZE)
-def process_data_with_sp_cached(dos_year: int, memberships_tuple: tuple, diagnoses_tuple: tuple):
-    """Cached version of the data processing function."""
+def drop_temp_tables(cursor):
+    """Drop the staging tables so idle pooled connections don't hold them in tempdb."""
     try:
-        memberships = [dict(m) for m in memberships_tuple]
-        diagnoses = [dict(d) for d in diagnoses_tuple]
-        with get_db_cursor() as cursor:
-            return process_data_with_sp(cursor, dos_year, memberships, diagnoses)
+        cursor.execute("""
+        IF OBJECT_ID('tempdb..#TempMembership') IS NOT NULL
+            DROP TABLE #TempMembership;
+        IF OBJECT_ID('tempdb..#TempDiagnosis') IS NOT NULL
+            DROP TABLE #TempDiagnosis;
+        """)
+    except Exception as e:
+        # create_temp_tables drops leftovers on the connection's next use
+        logger.warning(f"Failed to drop temp tables: {str(e)}")
+
+# Copies the staged rows into the SP's table types and runs it
+RUN_SUSPECT_SP_SQL = """
+    DECLARE @PmtYear INT = %s;
+    DECLARE @Membership AS InputMembership_PartC;
+    DECLARE @DxTable AS [InputDiagnosisSuspect];
+
+    INSERT INTO @Membership (
+        MemberID, BirthDate, Gender, RAType,
+        Hospice, LTIMCAID, NEMCAID, OREC
+    )
+    SELECT
+        MemberID, BirthDate, Gender, RAType,
+        Hospice, LTIMCAID, NEMCAID, OREC
+    FROM #TempMembership;
+
+    INSERT INTO @DxTable (MemberID, FromDOS, ThruDOS, DxCode, QualificationFlag, UnqualificationReason)
+    SELECT MemberID, FromDOS, ThruDOS, DxCode, QualificationFlag, UnqualificationReason
+    FROM #TempDiagnosis;
+
+    EXEC dbo.sp_RS_Medicare_PartC_Outer_Suspect @PmtYear, @Membership, @DxTable, 2;
+"""
+
+def make_cache_key(body):
+    """Hash a raw request body into a short cache key."""
+    return hashlib.blake2b(body, digest_size=16).digest()
+
+def cache_get(key):
+    """Look up cached SP results, returning None on a miss."""
+    if _redis is not None:
+        try:
+            cached = _redis.get(REDIS_KEY_PREFIX + key)
+        except redis.RedisError as e:
+            logger.warning(f"Redis cache read failed: {str(e)}")
+            return None
+        return orjson.loads(cached) if cached is not None else None
+    with _cache_lock:
+        return _cache.get(key)
+
+def cache_set(key, results):
+    """Store SP results for CACHE_TTL seconds."""
+    if _redis is not None:
+        try:
+            _redis.set(
+                REDIS_KEY_PREFIX + key,
+                orjson.dumps(results, default=orjson_default),
+                ex=CACHE_TTL
+            )
+        except redis.RedisError as e:
+            logger.warning(f"Redis cache write failed: {str(e)}")
+        return
+    with _cache_lock:
+        _cache[key] = results
+
+def clear_cache():
+    """Drop every cached SP result held by this worker."""
+    # Shared Redis entries are left to expire on their own
+    with _cache_lock:
+        _cache.clear()
+
+def process_data_uncached(request):
+    """Run the SP for a validated request, returning its result rows."""
+    with get_db_cursor() as (conn, cursor):
+        return process_data_with_sp(
+            conn, cursor, request.dos_year, request.memberships, request.diagnoses
+        )
+
+def process_data_with_sp_cached(key, request):
+    """Run the SP for a validated request and cache its result rows."""
+    try:
+        results = process_data_uncached(request)
+        cache_set(key, results)
+        return results
     except Exception as e:
         logger.error(f"Cache processing error: {str(e)}")
         raise
 
-def process_data_with_sp(cursor, dos_year, memberships, diagnoses):
+def bulk_insert(conn, cursor, table, rows):
+    """Load rows into an existing table via BCP, falling back to batched INSERTs."""
+    # Must run in autocommit mode (see process_data_with_sp)
+    try:
+        conn.bulk_copy(table, rows, batch_size=BULK_COPY_BATCH_SIZE)
+        return
+    except _mssql.MSSQLException as e:
+        # bulk_copy raises the low-level _mssql exceptions, not pymssql.Error
+        logger.warning(f"Bulk copy into {table} failed, falling back to INSERT: {str(e)}")
+        # Drop whatever is left of the aborted BCP before reusing the connection
+        conn._conn.cancel()
+        cursor.execute(f"TRUNCATE TABLE {table}")
+
+    # pymssql >= 2.3 sends batch_size single-row INSERTs per round-trip,
+    # joined into one batch.
+    placeholders = ', '.join(['%s'] * len(rows[0]))
+    cursor.executemany(
+        f"INSERT INTO {table} VALUES ({placeholders})",
+        rows,
+        batch_size=INSERT_BATCH_SIZE
+    )
+
+def fetch_rows(cursor):
+    """Read the current result set in chunks as response-ready dicts."""
+    columns = [column[0] for column in cursor.description]
+    rows = []
+    while True:
+        chunk = cursor.fetchmany(FETCH_BATCH_SIZE)
+        if not chunk:
+            break
+        # Only one chunk of tuples is alive next to the dicts at any time
+        rows.extend(dict(zip(columns, row)) for row in chunk)
+    return rows
+
+def process_data_with_sp(conn, cursor, dos_year, memberships, diagnoses):
     """Process data using the stored procedure."""
     try:
+        # BCP commits its own batches and aborts inside an open transaction.
+        # pymssql's autocommit(True) rolls back the current transaction, so
+        # switch before creating the temp tables or they would be dropped.
+        conn.autocommit(True)
         create_temp_tables(cursor)
-        logger.info('Temp tables created successfully')
- 
-        df_members = pd.DataFrame(memberships)
-        df_members = df_members.rename(columns={'DOB': 'BirthDate'})
-        total_members = len(df_members)
-        batch_size = 1000
- 
-        logger.info("Inserting membership data...")
-        for i in tqdm(range(0, total_members, batch_size), desc="Processing members"):
-            batch = df_members.iloc[i:i+batch_size]
-            for _, row in batch.iterrows():
-                cursor.execute("""
-                    INSERT INTO #TempMembership 
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                """, (
-                    str(row.MemberID),
-                    str(row.BirthDate),
-                    str(row.Gender),
-                    str(row.RAType),
-                    str(row.Hospice),
-                    str(row.get('LTIMCAID', 'N')),
-                    str(row.get('NEMCAID', 'N')),
-                    str(row.OREC)
-                ))
+        logger.debug('Temp tables created successfully')
  
-        df_diag = pd.DataFrame(diagnoses)
-        total_diag = len(df_diag)
- 
-        logger.info("Inserting diagnosis data...")
-        for i in tqdm(range(0, total_diag, batch_size), desc="Processing diagnoses"):
-            batch = df_diag.iloc[i:i+batch_size]
-            for _, row in batch.iterrows():
-                cursor.execute("""
-                    INSERT INTO #TempDiagnosis 
-                    VALUES (%s, %s, %s, %s,%s,%s)
-                """, (
-                    str(row.MemberID),
-                    str(row.FromDOS),
-                    str(row.ThruDOS),
-                    str(row.DxCode),
-                    int(row.QualificationFlag),
-                    str(row.UnqualificationReason)
-                ))
- 
-        logger.info('Executing stored procedure...')
-        cursor.execute("""
-            DECLARE @PmtYear INT = %s;
-            Declare @Membership as InputMembership_PartC
-            Declare @DxTable as [InputDiagnosisSuspect]
-            
-            INSERT INTO @Membership (
-                MemberID, BirthDate, Gender, RAType, 
-                Hospice, LTIMCAID, NEMCAID, OREC
+        mem_rows = [
+            (
+                m.MemberID,
+                m.DOB,
+                m.Gender,
+                m.RAType,
+                m.Hospice,
+                m.LTIMCAID,
+                m.NEMCAID,
+                m.OREC
             )
-            SELECT 
-                MemberID, BirthDate, Gender, RAType,
-                Hospice, LTIMCAID, NEMCAID, OREC
-            FROM #TempMembership;
-            
-            INSERT INTO @DxTable (MemberID, FromDOS, ThruDOS, DxCode,QualificationFlag,UnqualificationReason)
-            SELECT MemberID, FromDOS, ThruDOS, DxCode,QualificationFlag,UnqualificationReason
-            FROM #TempDiagnosis;
-   
+            for m in memberships
+        ]
+        diag_rows = [
+            (
+                d.MemberID,
+                d.FromDOS,
+                d.ThruDOS,
+                d.DxCode,
+                d.QualificationFlag,
+                d.UnqualificationReason
+            )
+            for d in diagnoses
+        ]
 
-                       
+        start = time.perf_counter()
+        if mem_rows:
+            bulk_insert(conn, cursor, '#TempMembership', mem_rows)
+        if diag_rows:
+            bulk_insert(conn, cursor, '#TempDiagnosis', diag_rows)
+        # Run the SP inside the transaction get_db_cursor commits or rolls back
+        conn.autocommit(False)
+        logger.info(
+            f"Inserted {len(mem_rows)} members and {len(diag_rows)} diagnoses "
+            f"in {time.perf_counter() - start:.2f}s"
+        )
  
-            EXEC dbo.sp_RS_Medicare_PartC_Outer_Suspect @PmtYear, @Membership, @DxTable,2;
-        """, (dos_year,))
+        start = time.perf_counter()
+        cursor.execute(RUN_SUSPECT_SP_SQL, (dos_year,))
         
-        results = cursor.fetchall()
-        logger.info(f"Retrieved {len(results)} records from stored procedure")
+        results = fetch_rows(cursor)
+        logger.info(
+            f"Retrieved {len(results)} records from stored procedure "
+            f"in {time.perf_counter() - start:.2f}s"
+        )
         return results
  
     except Exception as e:
         logger.error(f"Error in process_data_with_sp: {str(e)}")
         raise
+    finally:
+        drop_temp_tables(cursor)
+
+@app.on_event("startup")
+async def configure_thread_pool():
+    # pymssql is a blocking driver, so database work runs in anyio's worker
+    # threads; widen the default limiter so slow SP calls don't starve it.
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREAD_POOL_SIZE
 
 @app.get("/")
 async def root():
     return {"message": "Welcome to RAF Calculator API"}
 
-@app.post("/process_data")
-async def process_data(request: ProcessDataRequest):
+def payload_too_large():
+    return HTTPException(
+        status_code=413,
+        detail={
+            'status': 'error',
+            'message': f'Request body exceeds {MAX_BODY_BYTES} bytes',
+            'timestamp': datetime.now().isoformat()
+        }
+    )
+
+def validation_errors(exc):
+    """Shape pydantic errors like FastAPI's own request body validation."""
+    errors = []
+    for error in exc.errors(include_url=False):
+        if not error['loc']:
+            # Whole-body errors (e.g. json_invalid) carry the raw body as input;
+            # don't echo it back, same as FastAPI
+            error['input'] = {}
+        error['loc'] = ('body', *error['loc'])
+        errors.append(error)
+    return errors
+
+async def read_body(request: Request) -> bytes:
+    """Read the request body, rejecting it as soon as it exceeds MAX_BODY_BYTES."""
+    content_length = request.headers.get('content-length')
+    if content_length and content_length.isdigit() and int(content_length) > MAX_BODY_BYTES:
+        raise payload_too_large()
+    chunks = []
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > MAX_BODY_BYTES:
+            raise payload_too_large()
+        chunks.append(chunk)
+    return b''.join(chunks)
+
+# The body is read raw so cache hits skip validation; publish the model's
+# schema by hand, pointing its refs at the $defs embedded below.
+PROCESS_DATA_SCHEMA = ProcessDataRequest.model_json_schema(
+    ref_template="#/paths/~1process_data/post/requestBody/content/application~1json/schema/$defs/{model}"
+)
+
+@app.post(
+    "/process_data",
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {"application/json": {"schema": PROCESS_DATA_SCHEMA}}
+        }
+    }
+)
+async def process_data(request: Request):
     """API endpoint to handle data processing with caching."""
-    try:
-        logger.info(f"Processing data for {len(request.memberships)} members and {len(request.diagnoses)} diagnoses")
-        memberships_dict = [membership.model_dump() for membership in request.memberships]
-        diagnoses_dict = [diagnosis.model_dump() for diagnosis in request.diagnoses]
-        memberships_tuple = tuple(tuple(sorted(m.items())) for m in memberships_dict)
-        diagnoses_tuple = tuple(tuple(sorted(d.items())) for d in diagnoses_dict)
-        
+    body = await read_body(request)
+    cache_key = make_cache_key(body)
+    cached = await run_in_threadpool(cache_get, cache_key)
+
+    if cached is None:
         try:
-            results = process_data_with_sp_cached(
-                request.dos_year,
-                memberships_tuple,
-                diagnoses_tuple
-            )
+            data = ProcessDataRequest.model_validate_json(body)
+        except ValidationError as e:
+            raise RequestValidationError(validation_errors(e))
+
+    try:
+        if cached is not None:
+            results = cached
             cache_status = "Cache hit"
-        except Exception as e:
-            logger.error(f"Cache error: {str(e)}")
-            process_data_with_sp_cached.cache_clear()
-            results = process_data_with_sp_cached(
-                request.dos_year,
-                memberships_tuple,
-                diagnoses_tuple
-            )
+        else:
+            logger.info(f"Processing data for {len(data.memberships)} members and {len(data.diagnoses)} diagnoses")
+            # Oversized results would crowd everything else out of the cache
+            if len(data.memberships) + len(data.diagnoses) > CACHE_ROW_LIMIT:
+                process = partial(process_data_uncached, data)
+            else:
+                process = partial(process_data_with_sp_cached, cache_key, data)
+            try:
+                results = await run_in_threadpool(process)
+            except Exception as e:
+                logger.error(f"Cache error: {str(e)}")
+                clear_cache()
+                results = await run_in_threadpool(process)
             cache_status = "Cache miss"
             
         response_data = {
@@ -283,7 +586,8 @@ async def process_data(request: ProcessDataRequest):
             'timestamp': datetime.now().isoformat()
         }
         logger.info(f"Successfully processed {len(results)} records ({cache_status})")
-        return response_data
+        # Returning the response directly skips FastAPI's jsonable_encoder pass
+        return RAFJSONResponse(content=response_data)
  
     except Exception as e:
         error_message = str(e)